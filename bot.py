@@ -9,6 +9,16 @@ import faiss
 import numpy as np
 from neo4j import GraphDatabase
 from datetime import datetime
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlencode, parse_qs
+import sqlite3
+import hashlib
+import gzip
+import os
+import tempfile
+from types import SimpleNamespace
+import threading
+import time
 
 # ตั้งค่าการเชื่อมต่อกับ Neo4j
 URI = "neo4j://localhost:7687"
@@ -23,26 +33,147 @@ def run_query(query, parameters=None):
             return [record for record in result]
     driver.close()
 
+# ฟังก์ชันสำหรับรันคำสั่ง Neo4j แบบ stream ทีละ record (ไม่โหลดผลลัพธ์ทั้งหมดเข้าหน่วยความจำ)
+def stream_query(query, parameters=None, fetch_size=1000):
+    with GraphDatabase.driver(URI, auth=AUTH) as driver:
+        driver.verify_connectivity()
+        with driver.session(fetch_size=fetch_size) as session:
+            for record in session.run(query, parameters):
+                yield record
+
+# คำสั่งสร้าง constraint และ index ของฐานข้อมูล
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT user_id_unique IF NOT EXISTS FOR (u:User) REQUIRE u.user_id IS UNIQUE",
+    "CREATE CONSTRAINT scraped_text_hash_unique IF NOT EXISTS FOR (s:ScrapedText) REQUIRE s.hash IS UNIQUE",
+    "CREATE CONSTRAINT book_product_url_unique IF NOT EXISTS FOR (b:Book) REQUIRE b.product_url IS UNIQUE",
+    "CREATE INDEX chat_timestamp IF NOT EXISTS FOR (m:Chat) ON (m.timestamp)",
+    "CREATE INDEX bot_response_timestamp IF NOT EXISTS FOR (c:bot_response) ON (c.timestamp)",
+]
+
+SCHEMA_RETRY_AFTER = 10 * 60  # ถ้าสร้าง schema ไม่สำเร็จ จะลองใหม่หลังจากกี่วินาที
+
+schema_ready = False
+schema_failed_at = None
+schema_lock = threading.Lock()
+
+# ฟังก์ชันนับจำนวน user_id ที่มี node User ซ้ำกัน (ทำให้สร้าง constraint user_id_unique ไม่ได้)
+def count_duplicate_users(session):
+    result = session.run('''
+    MATCH (u:User)
+    WITH u.user_id AS user_id, count(*) AS n
+    WHERE n > 1
+    RETURN count(*) AS duplicates
+    ''')
+    return result.single()['duplicates']
+
+# ฟังก์ชันสร้าง schema ของ Neo4j ครั้งแรกที่มีการใช้งาน
+# ถ้าไม่สำเร็จจะรอ SCHEMA_RETRY_AFTER วินาทีก่อนลองใหม่ และ thread อื่นไม่ต้องรอระหว่างที่กำลังสร้าง
+def ensure_schema():
+    global schema_ready, schema_failed_at
+    if schema_ready:
+        return
+    if schema_failed_at is not None and time.monotonic() - schema_failed_at < SCHEMA_RETRY_AFTER:
+        return
+    if not schema_lock.acquire(blocking=False):
+        return
+    try:
+        with GraphDatabase.driver(URI, auth=AUTH) as driver:
+            driver.verify_connectivity()
+            with driver.session() as session:
+                try:
+                    for query in SCHEMA_QUERIES:
+                        session.run(query).consume()
+                except Exception:
+                    duplicates = count_duplicate_users(session)
+                    if duplicates:
+                        print(f"Error: มี user_id ที่มี node User ซ้ำกัน {duplicates} รายการ ต้องรวม node ก่อนจึงจะสร้าง constraint user_id_unique ได้")
+                    raise
+        schema_ready = True
+    except Exception as e:
+        schema_failed_at = time.monotonic()
+        print(f"Error: สร้าง schema ของ Neo4j ไม่สำเร็จ จะลองใหม่ใน {SCHEMA_RETRY_AFTER} วินาที - {e}")
+    finally:
+        schema_lock.release()
+
 # ฟังก์ชันบันทึกประวัติการสนทนาและ last_keyword ใน Neo4j พร้อมบันทึกผล scrape
-def store_chat_history_and_keyword(user_id, user_message, bot_response, last_keyword, scraped_text=None):
+def store_chat_history_and_keyword(user_id, user_message, bot_response, last_keyword, scraped_text=None, books=None):
+    ensure_schema()
     timestamp = datetime.now().isoformat()  # สร้าง timestamp
     query = '''
     MERGE (u:User {user_id: $user_id})
     SET u.last_keyword = $last_keyword
     CREATE (m:Chat {user_message: $user_message, timestamp: $timestamp})
-    CREATE (c:bot_response {bot_response: $bot_response, scraped_text: $scraped_text, timestamp: $timestamp})
+    CREATE (c:bot_response {bot_response: $bot_response, timestamp: $timestamp})
     MERGE (u)-[:question]->(m)-[:answer]->(c)
     '''
     parameters = {
         'user_id': user_id,
         'user_message': user_message,
         'bot_response': bot_response,
-        'scraped_text': scraped_text,
         'last_keyword': last_keyword,
         'timestamp': timestamp
     }
+    # ผล scrape เก็บเป็น node แยกตาม hash ของเนื้อหา ผลที่ซ้ำกันจะใช้ node เดียวกัน
+    if scraped_text:
+        query += '''
+    MERGE (s:ScrapedText {hash: $scraped_hash})
+    ON CREATE SET s.text = $scraped_text
+    CREATE (c)-[:scraped]->(s)
+    '''
+        parameters['scraped_text'] = scraped_text
+        parameters['scraped_hash'] = hashlib.sha256(scraped_text.encode('utf-8')).hexdigest()
+    # หนังสือที่แสดงให้ผู้ใช้เก็บเป็น node Book แยกตาม product_url สำหรับระบบแนะนำหนังสือ
+    books = [book for book in books or [] if book['product_url'].startswith("http")]
+    if books:
+        query += '''
+    WITH c
+    UNWIND $books AS book
+    MERGE (b:Book {product_url: book.product_url})
+    SET b.title = book.title, b.author = book.author, b.price = book.price,
+        b.rating = book.rating, b.img_url = book.img_url
+    MERGE (c)-[:shown]->(b)
+    '''
+        parameters['books'] = books
     run_query(query, parameters)
 
+# ฟังก์ชันดึงประวัติการสนทนาทั้งหมดแบบ stream สำหรับวิเคราะห์ข้อมูล (กรองช่วงเวลาได้)
+# since/until รับได้ทั้ง datetime และ string รูปแบบ ISO (timestamp ใน Neo4j เก็บเป็น string ISO เวลาท้องถิ่น)
+def export_chat_history(since=None, until=None, fetch_size=1000):
+    ensure_schema()
+    if isinstance(since, datetime):
+        since = since.isoformat()
+    if isinstance(until, datetime):
+        until = until.isoformat()
+    # สร้างเงื่อนไขเฉพาะที่ใช้จริง เพื่อให้ index chat_timestamp ใช้ได้ทั้งกรองช่วงเวลาและเรียงลำดับ
+    conditions = []
+    if since is not None:
+        conditions.append("m.timestamp >= $since")
+    if until is not None:
+        conditions.append("m.timestamp < $until")
+    if not conditions:
+        conditions.append("m.timestamp IS NOT NULL")
+    query = '''
+    MATCH (u:User)-[:question]->(m:Chat)-[:answer]->(c:bot_response)
+    WHERE ''' + " AND ".join(conditions) + '''
+    OPTIONAL MATCH (c)-[:scraped]->(s:ScrapedText)
+    RETURN u.user_id AS user_id, m.user_message AS user_message,
+           c.bot_response AS bot_response, m.timestamp AS timestamp,
+           coalesce(s.text, c.scraped_text) AS scraped_text
+    ORDER BY m.timestamp
+    '''
+    parameters = {'since': since, 'until': until}
+    for record in stream_query(query, parameters, fetch_size):
+        yield record.data()
+
+# ฟังก์ชันเขียนประวัติการสนทนาลงไฟล์ JSON Lines ทีละบรรทัด
+def export_chat_history_jsonl(path, since=None, until=None):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in export_chat_history(since, until):
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
 # ฟังก์ชันดึงค่า last_keyword จาก Neo4j
 def get_last_keyword(user_id):
     query = '''
@@ -201,31 +332,220 @@ def quick_reply_greeting2():
         ]
     )
 
-def scrape_synopsis(book_title):
-    # สมมติว่ามีฟังก์ชันหรือระบบที่ให้ URL ของหนังสือจากชื่อ
-    book_url = get_book_url_by_title(book_title)  # ต้องทำให้แน่ใจว่ามีฟังก์ชันนี้ หรือสร้างฟังก์ชันนี้ขึ้นมา
+# ตั้งค่าโหมด snapshot ของหน้าเว็บ naiin.com
+# live = ดึงจากเว็บจริง, record = ดึงจากเว็บจริงแล้วบันทึก snapshot, replay = อ่านจาก snapshot อย่างเดียว
+SNAPSHOT_MODE = os.environ.get("NAIIN_SNAPSHOT_MODE", "live")
+SNAPSHOT_DIR = os.environ.get("NAIIN_SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_LATENCY = float(os.environ.get("NAIIN_SNAPSHOT_LATENCY", "0"))  # หน่วงเวลา (วินาที) ตอน replay
+
+if SNAPSHOT_MODE not in ("live", "record", "replay"):
+    raise ValueError(f"NAIIN_SNAPSHOT_MODE ต้องเป็น live, record หรือ replay (ได้รับ {SNAPSHOT_MODE!r})")
+
+# ฟังก์ชันหา path ของไฟล์ snapshot จาก URL
+def snapshot_path(url):
+    return os.path.join(SNAPSHOT_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".json.gz")
+
+# ฟังก์ชันบันทึก response ลงไฟล์ snapshot แบบบีบอัด
+# เขียนลงไฟล์ชั่วคราวก่อนแล้วค่อยย้ายทับ เพื่อไม่ให้ request ที่เข้ามาพร้อมกันทำไฟล์เสีย
+def save_snapshot(url, response):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    snapshot = {"url": url, "status_code": response.status_code, "text": response.text}
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, snapshot_path(url))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# ฟังก์ชันอ่าน response จากไฟล์ snapshot (ถ้าไม่มีจะคืนรหัสสถานะ 404)
+def load_snapshot(url):
+    if SNAPSHOT_LATENCY:
+        time.sleep(SNAPSHOT_LATENCY)
+    path = snapshot_path(url)
+    if not os.path.exists(path):
+        print(f"Error: ไม่พบ snapshot ของ {url}")
+        return SimpleNamespace(status_code=404, text="")
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        snapshot = json.load(f)
+    return SimpleNamespace(status_code=snapshot["status_code"], text=snapshot["text"])
+
+# ฟังก์ชันดึงหน้าเว็บ naiin.com ตามโหมด snapshot ที่ตั้งไว้
+def fetch_page(url):
+    if SNAPSHOT_MODE == "replay":
+        return load_snapshot(url)
+    response = requests.get(url)
+    if SNAPSHOT_MODE == "record":
+        save_snapshot(url, response)
+    return response
+
+# ตั้งค่าที่เก็บเรื่องย่อแบบถาวร (SQLite) และ cache ในหน่วยความจำ
+SYNOPSIS_DB_PATH = os.environ.get("NAIIN_SYNOPSIS_DB", "synopsis.db")
+SYNOPSIS_CACHE_SIZE = 256  # จำนวนเรื่องย่อสูงสุดที่เก็บไว้ในหน่วยความจำ
+SYNOPSIS_MAX_AGE = 7 * 24 * 60 * 60  # อายุเรื่องย่อ (วินาที) ก่อนจะ refresh เบื้องหลัง
+SYNOPSIS_RETRY_AFTER = 60 * 60  # ถ้า refresh ไม่สำเร็จ จะลองใหม่หลังจากกี่วินาที
+BOOK_URL_CACHE_SIZE = 10000  # จำนวนชื่อหนังสือ -> URL ที่จำไว้สำหรับข้อความที่ผู้ใช้พิมพ์เอง
+
+synopsis_cache = OrderedDict()
+synopsis_cache_lock = threading.Lock()
+synopsis_refreshing = set()
+synopsis_local = threading.local()
+book_url_cache = OrderedDict()
+book_url_cache_lock = threading.Lock()
+
+# ฟังก์ชันดึงการเชื่อมต่อ SQLite ของ thread ปัจจุบัน (ใช้ร่วมกันตลอด request แล้วปิดเมื่อจบ request)
+def synopsis_db():
+    conn = getattr(synopsis_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SYNOPSIS_DB_PATH)
+        synopsis_local.conn = conn
+    return conn
+
+# ฟังก์ชันปิดการเชื่อมต่อ SQLite ของ thread ปัจจุบัน (เรียกเมื่อจบ request หรือจบ thread เบื้องหลัง)
+def close_synopsis_db():
+    conn = getattr(synopsis_local, 'conn', None)
+    if conn is not None:
+        synopsis_local.conn = None
+        conn.close()
+
+# ฟังก์ชันสร้างตารางเรื่องย่อ (เรียกครั้งเดียวตอนโหลดโมดูล)
+# synopsis = '' หมายถึงหน้าสินค้านั้นไม่มีเรื่องย่อ
+def init_synopsis_db():
+    conn = synopsis_db()
+    with conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS synopsis (
+            product_url TEXT PRIMARY KEY,
+            synopsis TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        )
+        ''')
+    close_synopsis_db()
+
+init_synopsis_db()
+
+# ฟังก์ชันจำ URL ของหนังสือที่แสดงให้ผู้ใช้แต่ละคน (แยกตาม user_id เพื่อไม่ให้ชื่อซ้ำกันทับกัน)
+def remember_book_urls(user_id, books):
+    with book_url_cache_lock:
+        for book in books:
+            key = (user_id, book['title'])
+            book_url_cache[key] = book['product_url']
+            book_url_cache.move_to_end(key)
+        while len(book_url_cache) > BOOK_URL_CACHE_SIZE:
+            book_url_cache.popitem(last=False)
+
+# ฟังก์ชันดึง URL จากชื่อหนังสือที่เคยแสดงให้ผู้ใช้คนนี้
+def get_book_url_by_title(book_title, user_id=None):
+    with book_url_cache_lock:
+        return book_url_cache.get((user_id, book_title))
+
+# ฟังก์ชันเก็บเรื่องย่อไว้ใน cache หน่วยความจำ (ตัดรายการที่ใช้นานที่สุดออกเมื่อเต็ม)
+def cache_synopsis(book_url, synopsis, fetched_at):
+    with synopsis_cache_lock:
+        synopsis_cache[book_url] = (synopsis, fetched_at)
+        synopsis_cache.move_to_end(book_url)
+        while len(synopsis_cache) > SYNOPSIS_CACHE_SIZE:
+            synopsis_cache.popitem(last=False)
+
+# ฟังก์ชันดึงเรื่องย่อจากหน้าสินค้า คืนค่า (เรื่องย่อ, ข้อความ error)
+# ถ้าหน้าสินค้าไม่มีเรื่องย่อจะคืน '' เพื่อให้บันทึกผลไว้ได้
+def fetch_synopsis(book_url):
+    response = fetch_page(book_url)
+
+    if response.status_code != 200:
+        return None, f"Error: ไม่สามารถเข้าถึง URL ได้ - รหัสสถานะ: {response.status_code}"
+
+    soup = BeautifulSoup(response.text, 'html.parser')
+
+    # ดึงข้อมูลเรื่องย่อจากแท็ก <p> แรกใน class "book-description"
+    synopsis_tag = soup.select_one('.book-decription p')
+
+    if not synopsis_tag:
+        return "", None
+    return synopsis_tag.get_text(strip=True), None
+
+# ฟังก์ชันบันทึกเรื่องย่อลง SQLite และ cache
+def store_synopsis(book_url, synopsis, fetched_at):
+    conn = synopsis_db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO synopsis (product_url, synopsis, fetched_at) VALUES (?, ?, ?)",
+            (book_url, synopsis, fetched_at)
+        )
+    cache_synopsis(book_url, synopsis, fetched_at)
+
+# ฟังก์ชันดึงเรื่องย่อใหม่แล้วบันทึกลง SQLite และ cache
+def refresh_synopsis(book_url):
+    synopsis, error = fetch_synopsis(book_url)
+    if synopsis is None:
+        return None, error
+    store_synopsis(book_url, synopsis, time.time())
+    return synopsis, None
+
+# ฟังก์ชัน refresh เรื่องย่อที่เก่าแล้วใน thread เบื้องหลัง (ไม่ให้ผู้ใช้ต้องรอ)
+def refresh_synopsis_in_background(book_url, stale_synopsis):
+    with synopsis_cache_lock:
+        if book_url in synopsis_refreshing:
+            return
+        synopsis_refreshing.add(book_url)
+
+    def worker():
+        try:
+            synopsis, error = refresh_synopsis(book_url)
+        except Exception as e:
+            synopsis, error = None, e
+        try:
+            if synopsis is None:
+                print(f"Error: refresh เรื่องย่อไม่สำเร็จ {book_url} - {error}")
+                # เก็บเรื่องย่อเดิมไว้และเลื่อนการลองใหม่ออกไป SYNOPSIS_RETRY_AFTER วินาที
+                store_synopsis(book_url, stale_synopsis, time.time() - SYNOPSIS_MAX_AGE + SYNOPSIS_RETRY_AFTER)
+        finally:
+            close_synopsis_db()
+            with synopsis_cache_lock:
+                synopsis_refreshing.discard(book_url)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+# ฟังก์ชันดึงเรื่องย่อตาม URL: cache -> SQLite -> เว็บ
+def get_synopsis(book_url):
+    with synopsis_cache_lock:
+        entry = synopsis_cache.get(book_url)
+        if entry:
+            synopsis_cache.move_to_end(book_url)
+
+    if entry is None:
+        entry = synopsis_db().execute(
+            "SELECT synopsis, fetched_at FROM synopsis WHERE product_url = ?",
+            (book_url,)
+        ).fetchone()
+        if entry:
+            cache_synopsis(book_url, entry[0], entry[1])
+
+    if entry is None:
+        synopsis, error = refresh_synopsis(book_url)
+        if synopsis is None:
+            return error
+    else:
+        synopsis, fetched_at = entry
+        if time.time() - fetched_at > SYNOPSIS_MAX_AGE:
+            refresh_synopsis_in_background(book_url, synopsis)
+    return synopsis or "ไม่พบเรื่องย่อ"
+
+def scrape_synopsis(book_title, user_id=None):
+    # หา URL ของหนังสือจากชื่อที่เคยแสดงให้ผู้ใช้คนนี้
+    book_url = get_book_url_by_title(book_title, user_id)
     
     if not book_url:
         return "ไม่พบ URL ของหนังสือจากชื่อที่ให้มา"
     
-    # ส่ง request เพื่อดึงข้อมูลจาก URL
-    response = requests.get(book_url)
-    
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # ดึงข้อมูลเรื่องย่อจากแท็ก <p> แรกใน class "book-description"
-        synopsis_tag = soup.select_one('.book-decription p')
-        
-        if synopsis_tag:
-            return synopsis_tag.get_text(strip=True)
-        else:
-            return "ไม่พบเรื่องย่อ"
-    else:
-        return f"Error: ไม่สามารถเข้าถึง URL ได้ - รหัสสถานะ: {response.status_code}"
+    return get_synopsis(book_url)
 
 
 
+# รูปปกสำรองเมื่อหน้าเว็บไม่มีรูปหนังสือ
+DEFAULT_BOOK_IMG = "https://drive.google.com/uc?export=view&id=13ihm2R69rRvt2tEHWsYbefED9CGP39vq"
+
 # ฟังก์ชันสำหรับการ scrape ข้อมูลหนังสือและสร้างข้อความ text
 def scrape_books(keyword, sort_by_rate=False, sort_by_price=False):
     url = f"https://www.naiin.com/search-result?title={keyword}"
@@ -233,7 +553,7 @@ def scrape_books(keyword, sort_by_rate=False, sort_by_price=False):
         url += "&sortBy=rate"
     elif sort_by_price:
         url += "&sortBy=price"
-    response = requests.get(url)
+    response = fetch_page(url)
     soup = BeautifulSoup(response.text, 'html.parser')
 
     books = []
@@ -247,7 +567,7 @@ def scrape_books(keyword, sort_by_rate=False, sort_by_price=False):
         product_item_div = book_item.parent  
         price = product_item_div.get('data-price', 'ไม่ระบุ')
         img_tag = book_item.parent.select_one('.item-img-block img')
-        img_url = img_tag.get('data-src') or img_tag.get('src') if img_tag else "https://drive.google.com/uc?export=view&id=13ihm2R69rRvt2tEHWsYbefED9CGP39vq"
+        img_url = img_tag.get('data-src') or img_tag.get('src') if img_tag else DEFAULT_BOOK_IMG
         rating_tag = book_item.find('span', class_='vote-scores')
         rating = rating_tag.text.strip() if rating_tag and rating_tag.text else 'ไม่มีคะแนน'
 
@@ -267,7 +587,7 @@ def scrape_books(keyword, sort_by_rate=False, sort_by_price=False):
 
 def scrape_fantasy_books(url):
     # ส่ง request เพื่อดึงข้อมูลจาก URL
-    response = requests.get(url)
+    response = fetch_page(url)
     soup = BeautifulSoup(response.text, 'html.parser')
 
     books = []
@@ -417,18 +737,11 @@ def llama_change(bot_response):
     except Exception as e:
         return f"เกิดข้อผิดพลาด: {e}"
 
-# ฟังก์ชันดึง URL จากชื่อหนังสือ
-def get_book_url_by_title(book_title):
-    return book_url_map.get(book_title, None)
-
-
-book_url_map = {}
-
 # ฟังก์ชันสำหรับสร้าง Flex Message พร้อมปุ่ม "ขอเรื่องย่อ"
-def create_flex_message(books):
+def create_flex_message(books, user_id=None):
+    remember_book_urls(user_id, books)
     bubbles = []
     for book in books:
-        book_url_map[book['title']] = book['product_url']
         bubble = {
             "type": "bubble",
             "hero": {
@@ -508,9 +821,10 @@ def create_flex_message(books):
                         "type": "button",
                         "style": "primary",
                         "action": {
-                            "type": "message",
+                            "type": "postback",
                             "label": "ขอเรื่องย่อ",
-                            "text": f"ขอเรื่องย่อ {book['title']}"
+                            "data": urlencode({"action": "synopsis", "url": book['product_url']}),
+                            "displayText": f"ขอเรื่องย่อ {book['title']}"
                         }
                     }
                 ]
@@ -526,25 +840,141 @@ def create_flex_message(books):
     
     return flex_message
 
+# ตั้งค่าระบบแนะนำหนังสือจากประวัติการค้นหา
+RECOMMENDATION_TOP_N = 5
+RECOMMENDATION_HISTORY_SIZE = 50  # ใช้หนังสือล่าสุดของผู้ใช้แต่ละคนไม่เกินกี่เล่ม
+RECOMMENDATION_REFRESH_INTERVAL = 60 * 60  # คำนวณรายการแนะนำใหม่ทุกกี่วินาที
+RECOMMENDATION_CO_SEEN_WEIGHT = 0.1  # น้ำหนักของหนังสือที่ผู้ใช้คนอื่นเห็นคู่กัน
+RECOMMENDATION_CO_SEEN_USERS = 50  # นับผู้ใช้คนอื่นที่เห็นหนังสือแต่ละเล่มไม่เกินกี่คน
+
+recommendations = {}
+recommendation_job_started = False
+recommendation_job_lock = threading.Lock()
+
+# ฟังก์ชันดึงหนังสือล่าสุดที่ผู้ใช้แต่ละคนเคยเห็นจาก Neo4j (node Book แยกตาม product_url)
+def load_user_books(history_size=RECOMMENDATION_HISTORY_SIZE):
+    query = '''
+    MATCH (u:User)-[:question]->(m:Chat)-[:answer]->(:bot_response)-[:shown]->(b:Book)
+    WITH u, b, max(m.timestamp) AS last_seen
+    ORDER BY last_seen DESC
+    WITH u, collect(b)[..$history_size] AS books
+    UNWIND books AS b
+    RETURN u.user_id AS user_id, b.product_url AS product_url, b.title AS title,
+           b.author AS author, b.price AS price, b.rating AS rating, b.img_url AS img_url
+    '''
+    user_books = defaultdict(set)
+    catalog = {}
+    for record in stream_query(query, {'history_size': history_size}):
+        book = record.data()
+        user_id = book.pop('user_id')
+        book['img_url'] = book['img_url'] or DEFAULT_BOOK_IMG
+        catalog[book['product_url']] = book
+        user_books[user_id].add(book['product_url'])
+    return user_books, catalog
+
+# ฟังก์ชันคำนวณรายการแนะนำ top-N ของผู้ใช้ทุกคน
+# คะแนน = ความคล้ายของชื่อหนังสือ (embedding) กับหนังสือที่ผู้ใช้เคยเห็น
+#        + จำนวนผู้ใช้คนอื่นที่เห็นหนังสือนั้นคู่กับหนังสือของผู้ใช้ (คิดเฉพาะหนังสือที่เป็นตัวเลือก)
+def build_recommendations(top_n=RECOMMENDATION_TOP_N):
+    user_books, catalog = load_user_books()
+    urls = list(catalog)
+    if not urls:
+        return {}
+    position = {url: i for i, url in enumerate(urls)}
+
+    vectors = encoder.encode([catalog[url]['title'] for url in urls])
+    faiss.normalize_L2(vectors)
+    book_index = faiss.IndexFlatIP(vectors.shape[1])
+    book_index.add(vectors)
+
+    # ผู้ใช้ที่เห็นหนังสือแต่ละเล่ม (จำกัดจำนวน เพื่อไม่ให้หนังสือยอดนิยมทำให้ batch ช้า)
+    seen_by = defaultdict(list)
+    for user_id, seen in user_books.items():
+        for url in seen:
+            if len(seen_by[url]) < RECOMMENDATION_CO_SEEN_USERS:
+                seen_by[url].append(user_id)
+
+    user_ids = list(user_books)
+    profiles = np.array(
+        [vectors[[position[url] for url in user_books[user_id]]].mean(axis=0) for user_id in user_ids],
+        dtype='float32'
+    )
+    faiss.normalize_L2(profiles)
+    candidates = top_n * 4  # จำนวนหนังสือที่ยังไม่เคยเห็นที่นำมาจัดอันดับใหม่ต่อผู้ใช้
+    k = min(len(urls), candidates + max(len(seen) for seen in user_books.values()))
+    similarities, neighbours = book_index.search(profiles, k)
+
+    result = {}
+    for row, user_id in enumerate(user_ids):
+        seen = user_books[user_id]
+        scores = {}
+        for similarity, i in zip(similarities[row], neighbours[row]):
+            if i < 0 or urls[i] in seen:
+                continue
+            if len(scores) == candidates:
+                break
+            # จำนวนหนังสือของผู้ใช้ที่ผู้ใช้คนอื่นซึ่งเห็นหนังสือเล่มนี้เคยเห็นด้วย
+            co_seen = sum(len(user_books[other] & seen) for other in seen_by[urls[i]])
+            scores[urls[i]] = float(similarity) + RECOMMENDATION_CO_SEEN_WEIGHT * np.log1p(co_seen)
+        best = sorted(scores, key=scores.get, reverse=True)[:top_n]
+        if best:
+            result[user_id] = [catalog[url] for url in best]
+    return result
+
+# ฟังก์ชันคำนวณรายการแนะนำใหม่แล้วสลับเข้า index ในหน่วยความจำ
+def refresh_recommendations():
+    global recommendations
+    recommendations = build_recommendations()
+
+# ฟังก์ชันเริ่ม batch job คำนวณรายการแนะนำเป็นระยะใน thread เบื้องหลัง
+def start_recommendation_job(interval=RECOMMENDATION_REFRESH_INTERVAL):
+    def worker():
+        while True:
+            try:
+                refresh_recommendations()
+            except Exception as e:
+                print(f"Error: คำนวณรายการแนะนำไม่สำเร็จ - {e}")
+            time.sleep(interval)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+# ฟังก์ชันดึงรายการแนะนำของผู้ใช้จาก index ในหน่วยความจำ (เริ่ม batch job ในครั้งแรกที่เรียก)
+def get_recommendations(user_id):
+    global recommendation_job_started
+    if not recommendation_job_started:
+        with recommendation_job_lock:
+            if not recommendation_job_started:
+                start_recommendation_job()
+                recommendation_job_started = True
+    return recommendations.get(user_id, [])
+
+# ฟังก์ชันคำนวณการตอบสนองของปุ่ม postback (ข้อมูลในปุ่มมี URL ของหนังสือมาด้วย ไม่ต้องหาจากชื่อ)
+def compute_postback_response(data, user_id):
+    params = parse_qs(data)
+    if params.get("action") == ["synopsis"] and params.get("url"):
+        synopsis = get_synopsis(params["url"][0])
+        return TextSendMessage(text=f"เรื่องย่อ: {synopsis}")
+    return TextSendMessage(text="ขอโทษครับ ผมไม่เข้าใจคำถามนี้")
+
 # ฟังก์ชันคำนวณการตอบสนอง
 def compute_response(sentence, user_id):
     intent = faiss_search(sentence)
 
     if sentence.startswith("ขอเรื่องย่อ"):
         # Scrape the synopsis for the given URL
-        product_url = sentence.replace("ขอเรื่องย่อ", "").strip()
-        synopsis = scrape_synopsis(product_url)
+        book_title = sentence.replace("ขอเรื่องย่อ", "").strip()
+        synopsis = scrape_synopsis(book_title, user_id)
         return TextSendMessage(text=f"เรื่องย่อ: {synopsis}")
 
     if sentence.startswith("ค้นหาหนังสือ"):
         keyword = sentence.replace("ค้นหาหนังสือ", "").strip()
         books, scraped_text = scrape_books(keyword)
         if books:
-            flex_message = create_flex_message(books)
+            flex_message = create_flex_message(books, user_id)
             flex_message.quick_reply = create_quick_reply()
             bot_response = f"พบหนังสือที่เกี่ยวกับ {keyword} มีดังนี้ครับ"
             bot_response = llama_change(bot_response)
-            store_chat_history_and_keyword(user_id, sentence, bot_response, keyword, scraped_text)
+            store_chat_history_and_keyword(user_id, sentence, bot_response, keyword, scraped_text, books)
             print(bot_response)
             return [TextSendMessage(text=bot_response),flex_message]
         else:
@@ -661,10 +1091,10 @@ def compute_response(sentence, user_id):
             return TextSendMessage(text="คุณยังไม่ได้ค้นหาหนังสือก่อนหน้า")
         books, scraped_text = scrape_books(last_keyword, sort_by_rate=True)
         if books:
-            flex_message = create_flex_message(books)
+            flex_message = create_flex_message(books, user_id)
             flex_message.quick_reply = create_quick_reply()
             bot_response = "เรียงหนังสือตามคะแนน"
-            store_chat_history_and_keyword(user_id, sentence, bot_response, last_keyword, scraped_text)
+            store_chat_history_and_keyword(user_id, sentence, bot_response, last_keyword, scraped_text, books)
             return flex_message
         else:
             bot_response = "ไม่พบข้อมูลหนังสือที่ค้นหา"
@@ -673,6 +1103,12 @@ def compute_response(sentence, user_id):
         
     elif intent == "แนะนำหนังสือหน่อยครับ":
         quick_reply = create_quick_reply_rec()  # สร้าง Quick Reply
+        books = get_recommendations(user_id)
+        if books:
+            flex_message = create_flex_message(books, user_id)
+            flex_message.quick_reply = quick_reply
+            bot_response = "หนังสือที่น่าจะถูกใจคุณครับ หรือเลือกหมวดหมู่ที่สนใจได้เลย"
+            return [TextSendMessage(text=bot_response), flex_message]
         bot_response = "เลือกหมวดหมู่ที่สนใจได้เลยครับ"
         return TextSendMessage(text=bot_response, quick_reply=quick_reply)
 
@@ -701,10 +1137,10 @@ def compute_response(sentence, user_id):
             return TextSendMessage(text="คุณยังไม่ได้ค้นหาหนังสือก่อนหน้า")
         books, scraped_text = scrape_books(last_keyword, sort_by_price=True)
         if books:
-            flex_message = create_flex_message(books)
+            flex_message = create_flex_message(books, user_id)
             flex_message.quick_reply = create_quick_reply()
             bot_response = "เรียงหนังสือตามราคา"
-            store_chat_history_and_keyword(user_id, sentence, bot_response, last_keyword, scraped_text)
+            store_chat_history_and_keyword(user_id, sentence, bot_response, last_keyword, scraped_text, books)
             return flex_message
         else:
             bot_response = "ไม่พบข้อมูลหนังสือที่ค้นหา"
@@ -713,7 +1149,7 @@ def compute_response(sentence, user_id):
     elif sentence.startswith("ขอเรื่องย่อ"):
         book_title = sentence.replace("ขอเรื่องย่อ", "").strip()  # ดึงชื่อหนังสือจากข้อความ
         # เรียกฟังก์ชัน scrape เรื่องย่อตามชื่อหนังสือ
-        synopsis = scrape_synopsis(book_title)  
+        synopsis = scrape_synopsis(book_title, user_id)
         
         if synopsis:
             return TextSendMessage(text=f"เรื่องย่อของหนังสือ '{book_title}':\n\n{synopsis}")
@@ -726,9 +1162,87 @@ def compute_response(sentence, user_id):
         store_chat_history_and_keyword(user_id, sentence, bot_response, "")
         return TextSendMessage(text=bot_response)
 
+# ตั้งค่าการกัน event ซ้ำและจำกัดความถี่ของข้อความต่อผู้ใช้
+EVENT_DEDUP_TTL = 10 * 60  # จำ event ที่เคยรับไว้กี่วินาที (LINE ส่งซ้ำเมื่อ timeout)
+EVENT_DEDUP_MAX = 10000
+RATE_LIMIT_CAPACITY = 5  # จำนวนข้อความที่ส่งติดกันได้
+RATE_LIMIT_REFILL = 0.5  # จำนวนข้อความที่ได้คืนต่อวินาที
+
+seen_events = OrderedDict()
+seen_events_lock = threading.Lock()
+rate_buckets = OrderedDict()  # เรียงตามเวลาที่ใช้ล่าสุด เพื่อให้ลบ bucket ที่ไม่ได้ใช้ได้เร็ว
+rate_buckets_lock = threading.Lock()
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+# ฟังก์ชันตรวจว่า event นี้เคยรับแล้วหรือยัง (ใช้ webhookEventId หรือ replyToken)
+def is_duplicate_event(event_key):
+    now = time.monotonic()
+    with seen_events_lock:
+        while seen_events:
+            key, seen_at = next(iter(seen_events.items()))
+            if now - seen_at <= EVENT_DEDUP_TTL and len(seen_events) <= EVENT_DEDUP_MAX:
+                break
+            seen_events.popitem(last=False)
+        if event_key in seen_events:
+            return True
+        seen_events[event_key] = now
+        return False
+
+# ฟังก์ชัน token bucket สำหรับจำกัดความถี่ข้อความของผู้ใช้แต่ละคน
+def allow_request(user_id):
+    now = time.monotonic()
+    with rate_buckets_lock:
+        # bucket ที่ว่างนานกว่า CAPACITY / REFILL วินาทีจะเต็มแล้ว ลบทิ้งได้โดยไม่เปลี่ยนผล
+        while rate_buckets:
+            _, last = next(iter(rate_buckets.values()))
+            if now - last <= RATE_LIMIT_CAPACITY / RATE_LIMIT_REFILL:
+                break
+            rate_buckets.popitem(last=False)
+        tokens, last = rate_buckets.pop(user_id, (RATE_LIMIT_CAPACITY, now))
+        tokens = min(RATE_LIMIT_CAPACITY, tokens + (now - last) * RATE_LIMIT_REFILL)
+        if tokens < 1:
+            rate_buckets[user_id] = (tokens, now)
+            return False
+        rate_buckets[user_id] = (tokens - 1, now)
+        return True
+
+# ฟังก์ชันคำนวณคำตอบโดยรวมคำสั่งเดียวกันของผู้ใช้คนเดียวกันที่เข้ามาพร้อมกันให้ทำครั้งเดียว
+# compute ใช้แยกข้อความพิมพ์กับปุ่ม postback ออกจากกัน
+def compute_response_once(msg, user_id, compute=compute_response):
+    key = (user_id, compute.__name__, msg)
+    with in_flight_lock:
+        entry = in_flight.get(key)
+        owner = entry is None
+        if owner:
+            entry = {'done': threading.Event(), 'result': None, 'error': None}
+            in_flight[key] = entry
+
+    if not owner:
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+    try:
+        entry['result'] = compute(msg, user_id)
+        return entry['result']
+    except Exception as e:
+        entry['error'] = e
+        raise
+    finally:
+        with in_flight_lock:
+            in_flight.pop(key, None)
+        entry['done'].set()
+
 # เชื่อมต่อกับ Line API
 app = Flask(__name__)
 
+# ปิดการเชื่อมต่อ SQLite ของเรื่องย่อเมื่อจบแต่ละ request
+@app.teardown_request
+def teardown_synopsis_db(exception=None):
+    close_synopsis_db()
+
 @app.route("/", methods=['POST'])
 def linebot():
     body = request.get_data(as_text=True)
@@ -740,12 +1254,23 @@ def linebot():
         handler = WebhookHandler(secret)
         signature = request.headers['X-Line-Signature']
         handler.handle(body, signature)
-        msg = json_data['events'][0]['message']['text']
-        tk = json_data['events'][0]['replyToken']
-        user_id = json_data['events'][0]['source']['userId']
-        response_msg = compute_response(msg, user_id)
+        event = json_data['events'][0]
+        event_key = event.get('webhookEventId') or event['replyToken']
+        if is_duplicate_event(event_key):
+            return 'OK'
+        tk = event['replyToken']
+        user_id = event['source']['userId']
+        if not allow_request(user_id):
+            line_bot_api.reply_message(tk, TextSendMessage(text="ส่งข้อความเร็วเกินไป กรุณารอสักครู่แล้วลองใหม่ครับ"))
+            return 'OK'
+        if event['type'] == 'postback':
+            msg = event['postback']['data']
+            response_msg = compute_response_once(msg, user_id, compute_postback_response)
+        else:
+            msg = event['message']['text']
+            response_msg = compute_response_once(msg, user_id)
         line_bot_api.reply_message(tk, response_msg)
-        print(msg, tk,book_url_map)
+        print(msg, tk)
     except Exception as e:
         print(body)
         print(f"Error: {e}")